@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import re
+import array
+import string
 import sys
 
 # MIPSレジスタ名と番号の対応
@@ -59,188 +60,307 @@ INSTRUCTIONS = {
     'j':    {'type': 'J', 'opcode': 0x02},
 }
 
-def to_binary(n, bits):
-    """数値を指定されたビット数の2の補数表現のバイナリ文字列に変換する"""
-    if n < 0:
-        n = (1 << bits) + n
-    return format(n, f'0{bits}b')
+# ラベル名に使用できる文字
+LABEL_CHARS = frozenset(string.ascii_letters + string.digits + '_')
+
+# オペランドの区切り文字を空白に置き換える変換テーブル
+SEPARATOR_TABLE = str.maketrans({',': ' ', '(': ' ', ')': ' '})
+
+# 8ビット値から2桁の16進文字列への変換表
+HEX8 = [format(i, '02x') for i in range(0x100)]
 
 def parse_register(reg_str):
     """レジスタ文字列を数値に変換"""
-    if reg_str not in REGISTER_MAP:
+    reg_num = REGISTER_MAP.get(reg_str)
+    if reg_num is None:
         raise ValueError(f"不明なレジスタです '{reg_str}'")
-    return REGISTER_MAP[reg_str]
+    return reg_num
 
-def assemble(line, symbol_table, current_address):
-    """アセンブリコード1行を機械語に変換"""
-    line = line.strip()
-    line = line.replace(',', ' ').replace('(', ' ').replace(')', ' ')
-    parts = line.split()
+def parse_immediate(imm_str):
+    """10進数または0x付き16進数の即値文字列を数値に変換"""
+    sign = imm_str[0]
+    digits = imm_str[1:] if sign in '+-' else imm_str
+    if digits[:2] not in ('0x', '0X'):
+        return int(imm_str)
+    value = int(digits, 16)
+    return -value if sign == '-' else value
 
-    if not parts:
-        return ""
+def try_parse_immediate(imm_str):
+    """即値文字列を数値に変換し、数値でなければ None を返す"""
+    try:
+        return parse_immediate(imm_str)
+    except ValueError:
+        return None
 
-    mnemonic = parts[0].lower()
-    if mnemonic not in INSTRUCTIONS:
-        raise ValueError(f"サポートされていない命令です '{parts[0]}'")
+def split_label(line):
+    """行頭のラベルを分離し、(ラベル または None, 命令部分) を返す"""
+    head, sep, rest = line.partition(':')
+    if sep and head and LABEL_CHARS.issuperset(head):
+        return head, rest.strip()
+    return None, line
 
-    info = INSTRUCTIONS[mnemonic]
-    op_type = info['type']
-    operands = parts[1:]
+def is_forward_reference(label, symbol_table, fixups):
+    """ラベルとして後で定義されうるオペランドの解決を後回しにできるかどうかを判定
 
-    binary_code = ""
+    数字だけのラベル (例: '5:') は即値より優先されるため、'40000' のような
+    数字だけのオペランドも未定義のラベルとして保留する。保留したオペランドの
+    エラー (範囲外の即値を含む) はパスの最後に報告される
+    """
+    return fixups is not None and label not in symbol_table and LABEL_CHARS.issuperset(label)
 
-    if op_type == 'R':
+def branch_offset_field(mnemonic, label, symbol_table, current_address):
+    """分岐先のラベルまたは即値を16ビットの分岐オフセットフィールドに変換"""
+    target_address = symbol_table.get(label)
+    if target_address is not None:
+        offset = target_address - (current_address + 4)
+        immediate = offset >> 2
+    else:
+        immediate = try_parse_immediate(label)
+        if immediate is None:
+            raise ValueError(f"'{mnemonic}' のラベルまたは即値が無効です: '{label}'")
+
+    if (immediate + 0x8000) & ~0xFFFF:
+        raise ValueError(f"'{mnemonic}' の分岐オフセットが16ビットの範囲外です: {immediate}")
+    return immediate & 0xFFFF
+
+def jump_target_field(mnemonic, label, symbol_table, current_address):
+    """ジャンプ先のラベルまたはアドレスを26ビットのターゲットフィールドに変換"""
+    target_address = symbol_table.get(label)
+    if target_address is None:
+        target_address = try_parse_immediate(label)
+        if target_address is None:
+            raise ValueError(f"'{mnemonic}' のラベルまたはアドレスが無効です: '{label}'")
+
+    if not (0 <= target_address < 1 << 28):
+        raise ValueError(f"'{mnemonic}' のジャンプ先アドレスが28ビットの範囲外です: {target_address:#x}")
+    if target_address % 4 != 0:
+        raise ValueError(f"ジャンプ先アドレス {target_address:#x} は4の倍数である必要があります")
+
+    return target_address >> 2
+
+def make_r_encoder(mnemonic, funct):
+    """R形式 (op $rd, $rs, $rt) のエンコーダを生成"""
+    def encode(operands, symbol_table, current_address, fixups=None):
         if len(operands) != 3:
             raise ValueError(f"'{mnemonic}' のオペランド数が正しくありません (3つ必要)")
+        rd, rs, rt = parse_register(operands[0]), parse_register(operands[1]), parse_register(operands[2])
+        return (rs << 21) | (rt << 16) | (rd << 11) | funct
+    return encode
 
-        if mnemonic == 'sll':
-            # sll $rd, $rt, shamt
-            rd, rt = parse_register(operands[0]), parse_register(operands[1])
-            try:
-                shamt = int(operands[2])
-                if not (0 <= shamt < 32):
-                    raise ValueError(f"'{mnemonic}' のシフト量は0から31の間の整数である必要があります")
-            except (ValueError, IndexError):
-                raise ValueError(f"'{mnemonic}' のシフト量は数値である必要があります")
-            rs = 0  # rs is not used in sll
-            binary_code = f"000000{to_binary(rs, 5)}{to_binary(rt, 5)}{to_binary(rd, 5)}{to_binary(shamt, 5)}{to_binary(info['funct'], 6)}"
-        else:
-            # other R-type: op $rd, $rs, $rt
-            rd, rs, rt = parse_register(operands[0]), parse_register(operands[1]), parse_register(operands[2])
-            shamt = 0
-            binary_code = f"000000{to_binary(rs, 5)}{to_binary(rt, 5)}{to_binary(rd, 5)}{to_binary(shamt, 5)}{to_binary(info['funct'], 6)}"
-
-    elif op_type == 'I':
-        opcode = to_binary(info['opcode'], 6)
-        if mnemonic in ['lw', 'sw']:
-            if len(operands) != 3:
-                raise ValueError(f"'{mnemonic}' のオペランド形式が不正です (例: lw $t1, 0($t2))")
-            rt, immediate_str, rs_str = operands[0], operands[1], operands[2]
-            rt, rs = parse_register(rt), parse_register(rs_str)
-            try:
-                immediate = int(immediate_str)
-            except ValueError:
-                raise ValueError(f"'{mnemonic}' のオフセットは数値である必要があります")
-            binary_code = f"{opcode}{to_binary(rs, 5)}{to_binary(rt, 5)}{to_binary(immediate, 16)}"
-        
-        elif mnemonic in ['beq', 'bne']:
-            if len(operands) != 3:
-                raise ValueError(f"'{mnemonic}' のオペランド数が正しくありません (3つ必要)")
-            rs, rt = parse_register(operands[0]), parse_register(operands[1])
-            label = operands[2]
-            
-            try:
-                if label in symbol_table:
-                    target_address = symbol_table[label]
-                    offset = target_address - (current_address + 4)
-                    immediate = offset >> 2
-                else:
-                    immediate = int(label)
-            except ValueError:
-                raise ValueError(f"'{mnemonic}' のラベルまたは即値が無効です: '{label}'")
-            
-            if not (-32768 <= immediate <= 32767):
-                raise ValueError(f"'{mnemonic}' の分岐オフセットが16ビットの範囲外です: {immediate}")
-            binary_code = f"{opcode}{to_binary(rs, 5)}{to_binary(rt, 5)}{to_binary(immediate, 16)}"
-
-        else:  # addi
-            if len(operands) != 3:
-                raise ValueError(f"'{mnemonic}' のオペランド数が正しくありません (3つ必要)")
-            rt, rs = parse_register(operands[0]), parse_register(operands[1])
-            try:
-                immediate = int(operands[2])
-            except ValueError:
-                raise ValueError(f"'{mnemonic}' の即値は数値である必要があります")
-            binary_code = f"{opcode}{to_binary(rs, 5)}{to_binary(rt, 5)}{to_binary(immediate, 16)}"
-
-    elif op_type == 'J':
+def make_shift_encoder(mnemonic, funct):
+    """シフト命令 (op $rd, $rt, shamt) のエンコーダを生成"""
+    def encode(operands, symbol_table, current_address, fixups=None):
+        if len(operands) != 3:
+            raise ValueError(f"'{mnemonic}' のオペランド数が正しくありません (3つ必要)")
+        rd, rt = parse_register(operands[0]), parse_register(operands[1])
+        shamt = try_parse_immediate(operands[2])
+        if shamt is None:
+            raise ValueError(f"'{mnemonic}' のシフト量は数値である必要があります")
+        if not (0 <= shamt < 32):
+            raise ValueError(f"'{mnemonic}' のシフト量は0から31の間の整数である必要があります")
+        # rs is not used in shift instructions
+        return (rt << 16) | (rd << 11) | (shamt << 6) | funct
+    return encode
+
+def make_arith_encoder(mnemonic, opcode):
+    """即値演算 (op $rt, $rs, imm) のエンコーダを生成"""
+    opcode <<= 26
+    def encode(operands, symbol_table, current_address, fixups=None):
+        if len(operands) != 3:
+            raise ValueError(f"'{mnemonic}' のオペランド数が正しくありません (3つ必要)")
+        rt, rs = parse_register(operands[0]), parse_register(operands[1])
+        immediate = try_parse_immediate(operands[2])
+        if immediate is None:
+            raise ValueError(f"'{mnemonic}' の即値は数値である必要があります")
+        if (immediate + 0x8000) & ~0xFFFF:
+            raise ValueError(f"'{mnemonic}' の即値が16ビットの範囲外です: {immediate}")
+        return opcode | (rs << 21) | (rt << 16) | (immediate & 0xFFFF)
+    return encode
+
+def make_mem_encoder(mnemonic, opcode):
+    """ロード・ストア (op $rt, offset($rs)) のエンコーダを生成"""
+    opcode <<= 26
+    def encode(operands, symbol_table, current_address, fixups=None):
+        if len(operands) != 3:
+            raise ValueError(f"'{mnemonic}' のオペランド形式が不正です (例: lw $t1, 0($t2))")
+        rt, rs = parse_register(operands[0]), parse_register(operands[2])
+        immediate = try_parse_immediate(operands[1])
+        if immediate is None:
+            raise ValueError(f"'{mnemonic}' のオフセットは数値である必要があります")
+        if (immediate + 0x8000) & ~0xFFFF:
+            raise ValueError(f"'{mnemonic}' のオフセットが16ビットの範囲外です: {immediate}")
+        return opcode | (rs << 21) | (rt << 16) | (immediate & 0xFFFF)
+    return encode
+
+def make_branch_encoder(mnemonic, opcode):
+    """条件分岐 (op $rs, $rt, label) のエンコーダを生成"""
+    opcode <<= 26
+    def encode(operands, symbol_table, current_address, fixups=None):
+        if len(operands) != 3:
+            raise ValueError(f"'{mnemonic}' のオペランド数が正しくありません (3つ必要)")
+        rs, rt = parse_register(operands[0]), parse_register(operands[1])
+        word = opcode | (rs << 21) | (rt << 16)
+        label = operands[2]
+        if is_forward_reference(label, symbol_table, fixups):
+            fixups.append((branch_offset_field, mnemonic, label, current_address))
+            return word
+        return word | branch_offset_field(mnemonic, label, symbol_table, current_address)
+    return encode
+
+def make_jump_encoder(mnemonic, opcode):
+    """ジャンプ (op label) のエンコーダを生成"""
+    opcode <<= 26
+    def encode(operands, symbol_table, current_address, fixups=None):
         if len(operands) != 1:
             raise ValueError(f"'{mnemonic}' のオペランド数が正しくありません (1つ必要)")
         label = operands[0]
-        try:
-            if label in symbol_table:
-                target_address = symbol_table[label]
-            else:
-                target_address = int(label)
-        except ValueError:
-            raise ValueError(f"'{mnemonic}' のラベルまたはアドレスが無効です: '{label}'")
-        
-        if target_address % 4 != 0:
-            raise ValueError(f"ジャンプ先アドレス {target_address:#x} は4の倍数である必要があります")
-        
-        jump_target = target_address >> 2
-        binary_code = f"{to_binary(info['opcode'], 6)}{to_binary(jump_target, 26)}"
+        if is_forward_reference(label, symbol_table, fixups):
+            fixups.append((jump_target_field, mnemonic, label, current_address))
+            return opcode
+        return opcode | jump_target_field(mnemonic, label, symbol_table, current_address)
+    return encode
+
+def make_encoder(mnemonic, info):
+    """命令の種類に応じたエンコーダを生成"""
+    if info['type'] == 'R':
+        if mnemonic == 'sll':
+            return make_shift_encoder(mnemonic, info['funct'])
+        return make_r_encoder(mnemonic, info['funct'])
+    if info['type'] == 'I':
+        if mnemonic in ('lw', 'sw'):
+            return make_mem_encoder(mnemonic, info['opcode'])
+        if mnemonic in ('beq', 'bne'):
+            return make_branch_encoder(mnemonic, info['opcode'])
+        return make_arith_encoder(mnemonic, info['opcode'])
+    return make_jump_encoder(mnemonic, info['opcode'])
+
+# 命令ごとのエンコーダ (起動時に一度だけ生成する)
+ENCODERS = {mnemonic: make_encoder(mnemonic, info) for mnemonic, info in INSTRUCTIONS.items()}
 
-    hex_code = format(int(binary_code, 2), '08x')
-    return f"0x{hex_code[:4]}_{hex_code[4:]}"
+def encode(line, symbol_table, current_address, fixups=None):
+    """アセンブリコード1行を32ビットの機械語 (整数) に変換
+
+    fixups にリストを渡すと、未定義のラベルの解決を保留し
+    (フィールド変換関数, 命令, ラベル, アドレス) を追加する
+    """
+    parts = line.translate(SEPARATOR_TABLE).split()
+
+    if not parts:
+        return None
+
+    encoder = ENCODERS.get(parts[0].lower())
+    if encoder is None:
+        raise ValueError(f"サポートされていない命令です '{parts[0]}'")
+
+    return encoder(parts[1:], symbol_table, current_address, fixups)
+
+def format_word(word):
+    """機械語を 0xXXXX_XXXX 形式の文字列に変換"""
+    return f"0x{HEX8[word >> 24]}{HEX8[(word >> 16) & 0xFF]}_{HEX8[(word >> 8) & 0xFF]}{HEX8[word & 0xFF]}"
+
+def assemble(line, symbol_table, current_address):
+    """アセンブリコード1行を機械語に変換"""
+    word = encode(line, symbol_table, current_address)
+    if word is None:
+        return ""
+    return format_word(word)
+
+def line_error(original_line, e):
+    """エラーに元の行を付加する"""
+    return ValueError(f"エラー (行: '{original_line.strip()}'): {e}")
+
+def encode_line(original_line, instruction_part, symbol_table, address, fixups=None):
+    """命令部分を機械語に変換し、エラーには元の行を付加する"""
+    try:
+        return encode(instruction_part, symbol_table, address, fixups)
+    except ValueError as e:
+        raise line_error(original_line, e)
+
+def preprocess(lines):
+    """コメントと空行を除き、各行を (元の行, ラベル または None, 命令部分) に分解する"""
+    parsed_lines = []
+    for original_line in lines:
+        line = original_line.partition('#')[0].strip()
+        if line:
+            label, instruction_part = split_label(line)
+            parsed_lines.append((original_line, label, instruction_part))
+    return parsed_lines
+
+def define_label(symbol_table, label, address):
+    """ラベルをシンボルテーブルに登録する"""
+    if label in symbol_table:
+        raise ValueError(f"ラベル '{label}' が重複して定義されています")
+    symbol_table[label] = address
 
 def first_pass(lines):
     """1回目のパス: ラベルをシンボルテーブルに登録する"""
     symbol_table = {}
     address = 0  # 簡潔さのため、0番地から開始
 
-    for line in lines:
-        line = line.split('#')[0].strip()
-        if not line:
-            continue
-
-        match = re.match(r'^\s*([a-zA-Z0-9_]+):\s*(.*)', line)
-        if match:
-            label, instruction_part = match.group(1), match.group(2).strip()
-            if label in symbol_table:
-                raise ValueError(f"ラベル '{label}' が重複して定義されています")
-            symbol_table[label] = address
-            if instruction_part:
-                address += 4
-        else:
+    for _, label, instruction_part in preprocess(lines):
+        if label is not None:
+            define_label(symbol_table, label, address)
+        if instruction_part:
             address += 4
     return symbol_table
 
 def second_pass(lines, symbol_table):
-    """2回目のパス: 各命令を機械語に変換する"""
-    machine_codes = []
+    """2回目のパス: 各命令を機械語に変換し、(機械語の配列, 対応する元の行) を返す"""
+    words = array.array('I')
+    source_lines = []
     address = 0
 
-    for original_line in lines:
-        line = original_line.split('#')[0].strip()
-        if not line:
+    for original_line, _, instruction_part in preprocess(lines):
+        if not instruction_part:
             continue
 
-        instruction_part = line
-        match = re.match(r'^\s*([a-zA-Z0-9_]+):\s*(.*)', line)
-        if match:
-            instruction_part = match.group(2).strip()
+        words.append(encode_line(original_line, instruction_part, symbol_table, address))
+        source_lines.append(original_line)
+        address += 4
+    return words, source_lines
+
+def assemble_program(lines):
+    """1回のパスでラベル登録と機械語変換を行い、前方参照は最後にまとめて解決する"""
+    symbol_table = {}
+    words = array.array('I')
+    source_lines = []
+    fixups = []  # (フィールド変換関数, 命令, ラベル, アドレス)
+    address = 0
+
+    for original_line, label, instruction_part in preprocess(lines):
+        if label is not None:
+            define_label(symbol_table, label, address)
 
         if not instruction_part:
-            machine_codes.append((original_line, None))
             continue
 
+        # 前方参照のラベルはフィールドを0にしたまま出力し、最後に埋める
+        words.append(encode_line(original_line, instruction_part, symbol_table, address, fixups))
+        source_lines.append(original_line)
+        address += 4
+
+    for resolve, mnemonic, label, fixup_address in fixups:
+        index = fixup_address >> 2  # アドレスは0番地から4ずつ増える
         try:
-            code = assemble(instruction_part, symbol_table, address)
-            machine_codes.append((original_line, code))
+            words[index] |= resolve(mnemonic, label, symbol_table, fixup_address)
         except ValueError as e:
-            raise ValueError(f"エラー (行: '{original_line.strip()}'): {e}")
-        
-        address += 4
-    return machine_codes
+            raise line_error(source_lines[index], e)
+    return words, source_lines
 
 def main():
     """複数行のアセンブリコードを受け取り、変換結果を表示する"""
     print("MIPS アセンブラ (複数行・ラベル対応)")
     print("アセンブリコードを入力してください。入力が終わったら Ctrl+D を押してください。")
     
-    lines = sys.stdin.readlines()
+    lines = sys.stdin.read().split('\n')
     print("...入力受付完了。アセンブルを開始します...")
 
     try:
-        symbol_table = first_pass(lines)
-        machine_codes = second_pass(lines, symbol_table)
+        words, source_lines = assemble_program(lines)
 
+        output = [f"{format_word(word)}\t# {original_line.strip()}\n" for word, original_line in zip(words, source_lines)]
         print("\n--- 機械語出力 ---")
-        for original_line, code in machine_codes:
-            if code:
-                print(f"{code}\t# {original_line.strip()}")
+        sys.stdout.write("".join(output))
 
     except ValueError as e:
         print(e, file=sys.stderr)